@@ -21,19 +21,27 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import argparse
+import concurrent.futures
+import contextlib
 import functools
 import itertools
+import os
 import pathlib
 import re
 import sys
 from enum import Enum
-from typing import Callable, List, Optional, TypeVar, Type, Iterable
+from typing import TYPE_CHECKING, BinaryIO, Callable, Iterator, List, Optional, TypeVar, Type, Iterable
+
+if TYPE_CHECKING:
+    import argparse
 
 # Keep script name in global constant
 SCRIPT_NAME = pathlib.Path(__file__).name
 # Type vairable for type annotation in ManifestFile class.
 S = TypeVar("S", bound="ManifestFile")
+# Number of threads used for inferring reads' direction. Inference is I/O bound,
+# so more threads than CPUs are used.
+MAX_WORKERS = min(32, (os.cpu_count() or 1) * 4)
 
 
 # Custom Error
@@ -51,28 +59,38 @@ class Direction(Enum):
     Unknown = "Unknown"
 
 
+# Values of Direction members, cached for use when generating manifest rows.
+_FWD = Direction.Forward.value
+_REV = Direction.Reverse.value
+_UNK = Direction.Unknown.value
+
+
 class ManifestFile:
     """Represents manifest file."""
 
-    HEADER = "sample-id,absolute-filepath,direction\n"
+    HEADER = b"sample-id,absolute-filepath,direction\n"
+    # Formatter of manifest file entries (rows). Manifest always has the same
+    # three columns, so the template is built only once.
+    _ROW = "{},{},{}\n".format
 
     def __init__(self, filepath: pathlib.Path) -> None:
         self._path: pathlib.Path = filepath
         self.name: str = self._path.name
         self.exists = self._path.exists()
-        # Lines represent entries in manifest file.
-        # Lines that should already be in file.
-        self._lines: List[str] = []
+        # Lines represent entries in manifest file. They are kept as encoded
+        # bytes, so they can be written to a file opened in binary mode.
+        # Lines that were already in file when it was read.
+        self._lines: List[bytes] = []
         # Lines that have not been written to the file yet.
-        self._unwritten_lines = [self.HEADER]
+        self._unwritten_lines: List[bytes] = [self.HEADER]
 
     @classmethod
     def from_file(cls: Type[S], filepath: pathlib.Path) -> S:
         """Returns a ManifestFile class instance from path to existing manifest file."""
-        lines: List[str] = []
-        with open(filepath, "r") as file:
-            for line in file.readlines():
-                lines.append(line)
+        lines: List[bytes] = []
+        with open(filepath, "rb") as file:
+            # Extend straight from the file iterator, without intermediate list.
+            lines.extend(file)
         # Create a new ManifestFile instance
         new = cls(filepath)
         # Overwrite ._lines attribute with lines read from existing manifest file.
@@ -82,48 +100,102 @@ class ManifestFile:
         return new
 
     @property
-    def lines(self) -> List[str]:
-        """List of lines that should've already been written to the file"""
+    def lines(self) -> List[bytes]:
+        """List of lines read from existing manifest file.
+
+        Lines written by this instance are not added to this list."""
         return self._lines
 
     @property
-    def unwritten_lines(self) -> List[str]:
+    def unwritten_lines(self) -> List[bytes]:
         """List of lines that were not yet written to the file."""
         return self._unwritten_lines
 
-    def add_file(self, name: str, file_path: str, direction: Direction) -> None:
-        """Adds new file entry (row) to the manifest file list of unwritten lines."""
-        self._unwritten_lines.append(f"{name},{file_path},{direction.value}\n")
+    def add_file(self, name: str, file_path: str, direction: str) -> None:
+        """Adds new file entry (row) to the manifest file list of unwritten lines.
+
+        direction should be a value of one of Direction members."""
+        self._unwritten_lines.append(self._ROW(name, file_path, direction).encode())
 
     def extend_manifest(
         self,
         files: Iterable[pathlib.Path],
         infer: bool,
-        substitution_function: Optional[Callable]= None
+        substitution_function: Optional[Callable]= None,
+        handle: Optional[BinaryIO] = None,
+        *,
+        directions: Optional[Iterable[str]] = None,
     ) -> None:
-        """Adds entries to the ManifestFile for all files in files Iterable."""
-        for file in files:
-            direction = Direction.Unknown
+        """Adds entries to the ManifestFile for all files in files Iterable.
+
+        If infer is True, directions of reads are inferred for all files, unless
+        already inferred directions (values of Direction members, e.g. returned by
+        infer_directions) are given. Otherwise direction of all files is Unknown.
+        If handle is given, entries are written straight to it instead of being
+        added to the list of unwritten lines.
+
+        Raises: ValueError if number of given directions doesn't match number of files"""
+        # Either buffer the rows in memory or write them as they are generated.
+        write = self._unwritten_lines.append if handle is None else handle.write
+        row = self._ROW
+        # Path.absolute() looks up current working directory on every call,
+        # so it's looked up only once here.
+        cwd = os.getcwd()
+        if not infer:
+            directions = itertools.repeat(_UNK)
+        elif directions is None:
+            files = list(files)
+            directions = infer_directions(files)
+        else:
+            files, directions = list(files), list(directions)
+            # Don't silently drop entries for files without a direction.
+            if len(files) != len(directions):
+                raise ValueError(
+                    f"got {len(directions)} directions for {len(files)} files"
+                )
+        for file, direction in zip(files, directions):
             filename = file.stem
-            if infer:
-                direction = infer_direction(file)
             if substitution_function is not None:
                 filename = substitution_function(string=filename)
-            self.add_file(filename, f"{file.absolute()}", direction)
+            file_path = str(file) if file.is_absolute() else os.path.join(cwd, file)
+            write(row(filename, file_path, direction).encode())
 
     def emit(self, mode: str) -> None:
-        """Creates new manifest file or appends to manifest file  on the filesystem."""
-        with open(self.name, mode) as file:
-            for line in self._unwritten_lines:
-                file.write(line)
-        # Move unwritten lines to self._lines and then remove the
-        # contents of self._unwritten_lines
-        self._lines.extend(self.unwritten_lines)
+        """Creates new manifest file or appends to manifest file  on the filesystem.
+
+        Writes all lines that were not yet written at once. It's kept for library
+        callers that build the whole manifest in memory (e.g. with add_file); the
+        script itself writes rows as they are generated with open_stream. File is
+        always opened in binary mode, so mode should be "w" or "a"."""
+        with open(self.name, f"{mode}b") as file:
+            self.write_to(file)
+
+    def write_to(self, handle: BinaryIO) -> None:
+        """Writes lines that were not yet written to the file handle."""
+        # Single write call instead of one call per line.
+        handle.write(b"".join(self._unwritten_lines))
+        # Written lines are not kept in memory, just remove the contents of
+        # self._unwritten_lines
         self._unwritten_lines.clear()
 
+    @contextlib.contextmanager
+    def open_stream(self, mode: str) -> Iterator[BinaryIO]:
+        """Opens manifest file on the filesystem and yields a handle for writing.
 
-def parse_args() -> argparse.Namespace:
+        Lines that were not yet written (e.g. header of a new manifest file) are
+        written to the file first. File is always opened in binary mode, so mode
+        should be "w" or "a"."""
+        with open(self.name, f"{mode}b") as file:
+            self.write_to(file)
+            yield file
+
+
+def parse_args() -> "argparse.Namespace":
     """Returns parsed command-line arguments of the script."""
+    # Imported here, so that importing this module as a library doesn't
+    # import argparse.
+    import argparse
+
     description = (
         "simple command-line utility for generating meanifest files for qiime2. "
         "Sample names (sample-id column) are generated automatically and usually "
@@ -138,7 +210,14 @@ def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description=description)
     output = parser.add_mutually_exclusive_group()
     parser.add_argument(
-        "files", type=str, nargs="+", metavar="file", help="file(s) to add to manifest"
+        "files", type=str, nargs="*", metavar="file", help="file(s) to add to manifest"
+    )
+    parser.add_argument(
+        "-d",
+        "--from-dir",
+        type=str,
+        metavar="DIR",
+        help="add all fastq files from directory DIR to manifest",
     )
     output.add_argument(
         "-o",
@@ -172,67 +251,133 @@ def parse_args() -> argparse.Namespace:
         type=str,
         help="Regular expression that will be matched against file names to create sample names",
     )
-    return parser.parse_args()
+    args = parser.parse_args()
+    if not args.files and not args.from_dir:
+        parser.error("at least one file or -d option is required")
+    return args
 
 
 # raises InferenceError
-def infer_direction(filepath: pathlib.Path, n=100) -> Direction:
+def infer_direction(filepath: pathlib.Path, size: int = 4096) -> str:
     """Returns a direction of reads in a file given by a filepath.
 
+    Direction is returned as a value of one of Direction members, which can be
+    passed straight to ManifestFile.add_file. Use infer_direction_enum to get
+    a Direction member instead.
+
     It is assumed here that all reads in a file are same members of their pairs, i.e.
-    All are either forward or reverse. This function checks first n lines for a file
+    All are either forward or reverse. This function checks first size bytes of a file
     in seach of sequence identifier from which it can infer the direction of a sequence.
+    If identifier doesn't contain a number of a member of a pair, Unknown is returned.
+
+    Raises: InferenceError if identifier has no space and isn't in pre-Casava 1.8
+    format either (has less than five colon-separated fields)."""
+
+    # Only the first identifier is needed, so a single unbuffered read of the
+    # beginning of a file is enough.
+    fd = os.open(filepath, os.O_RDONLY)
+    try:
+        buffer = os.read(fd, size)
+    finally:
+        os.close(fd)
+
+    # Get a number representing a member of a pair of paired end reads (1 or 2).
+    # It is assumed here that first member (1) is always in forward direction
+    # and second (2) member is always in reverse.
+    member_number: bytes = b""
+    # Identifier is the first line starting with "@". If there is none,
+    # start is 0 and the check below fails.
+    start = 0 if buffer.startswith(b"@") else buffer.find(b"\n@") + 1
+    if buffer.startswith(b"@", start):
+        end = buffer.find(b"\n", start)
+        header = buffer[start : end if end != -1 else len(buffer)].rstrip()
+        space = header.find(b" ")
+        if space != -1:
+            # post-Casava 1.8, e.g. @EAS139:136:FC706VJ:2:2104:15343:197393 1:Y:18:ATCACG
+            # Member number is the second space-separated field up to the first
+            # colon, which also covers e.g. SRA identifiers: @SRR390728.1 1 length=72
+            next_space = header.find(b" ", space + 1)
+            field = header[space + 1 : next_space if next_space != -1 else len(header)]
+            colon = field.find(b":")
+            member_number = field[:colon] if colon != -1 else field
+        else:
+            # pre-Casava 1.8, e.g. @HWUSI-EAS100R:6:73:941:1973#0/1
+            fields = header.split(b":")
+            if len(fields) < 5:
+                # Identifier is in neither format, e.g. bare @id. Raise inference
+                # error, as there was no way to infer.
+                raise InferenceError(
+                    f"{SCRIPT_NAME}: error: couldn't infer direction in file: {filepath.name}"
+                )
+            member_number = fields[4][-1:]
+    if member_number == b"1":
+        return _FWD
+    elif member_number == b"2":
+        return _REV
+    else:
+        # Return Unknown if for some reason member_number was not 1 or 2 after parsing.
+        return _UNK
+
+
+# raises InferenceError
+def infer_direction_enum(filepath: pathlib.Path, size: int = 4096) -> Direction:
+    """Returns a direction of reads in a file given by a filepath as Direction member.
 
     Raises: InferenceError"""
+    return Direction(infer_direction(filepath, size))
 
-    # Anonymous functions for getting a number representing a member of a pair
-    # of paired end reads (1 or 2). It is assumed here that first member (1) is
-    # always in forward direction and second (2) member is always in reverse.
-    old_format = lambda x: x.split(":")[4][-1]  # pre-Casava 1.8
-    new_format = lambda x: x.split(" ")[1].split(":")[0]  # post-Casava 1.8
-    member_number: int = 0
-    with open(filepath, "r") as file:
-        # Create an iterator containing only first n lines of a file.
-        lines = itertools.islice(file, n)
-        for line in lines:
-            # Check only identifier lines.
-            if line.startswith("@"):
-                try:
-                    member_number = new_format(line)
-                except IndexError:
-                    member_number = old_format(line)
-                except (IndexError, TypeError):
-                    # Raise inference error if wasn't able to infer.
-                    raise InferenceError(
-                        f"{SCRIPT_NAME}: error: couldn't infer direction in file: {filepath.name}"
-                    )
-                break
-    if member_number == "1":
-        return Direction.Forward
-    elif member_number == "2":
-        return Direction.Reverse
-    else:
-        # Return Unknown if for some reason member_number was not 1 or 2 after parsing.
-        return Direction.Unknown
+
+# raises InferenceError
+def infer_directions(files: Iterable[pathlib.Path]) -> List[str]:
+    """Returns directions of reads in all files, in the same order as files.
+
+    Directions are inferred concurrently, as inference is I/O bound.
+
+    Raises: InferenceError"""
+    executor = concurrent.futures.ThreadPoolExecutor(MAX_WORKERS)
+    try:
+        directions = list(executor.map(infer_direction, files))
+    except BaseException:
+        # Don't wait for inference in remaining files if it failed for one.
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    executor.shutdown()
+    return directions
 
 
 def main() -> int:
     args = parse_args()
     # Get paths to files as pathlb.Path objects. Makes working with paths later, easier.
-    files = [pathlib.Path(file) for file in args.files]
-
-    # if any of the files is not a fastq file print an error message and return 1,
-    # meaning a failure
-    if not all(".fastq" == file.suffix for file in files):
-        print(
-            f"{SCRIPT_NAME}: error: All files must be valid fastq files and their names must end with '.fastq'"
-        )
-        return 1
-    if not all(file.exists() for file in files):
-        print(
-            f"{SCRIPT_NAME}: error: [Errno 2] No such file or directory '{next(filter(lambda x: not x.exists(), files))}'"
-        )
-        return 2
+    # Files are validated in a single pass, stopping at first invalid file.
+    files: List[pathlib.Path] = []
+    for name in args.files:
+        # if any of the files is not a fastq file print an error message and
+        # return 1, meaning a failure. If it doesn't exist, return 2.
+        if not name.endswith(".fastq"):
+            print(
+                f"{SCRIPT_NAME}: error: All files must be valid fastq files and their names must end with '.fastq'"
+            )
+            return 1
+        file = pathlib.Path(name)
+        if not file.exists():
+            print(f"{SCRIPT_NAME}: error: [Errno 2] No such file or directory '{file}'")
+            return 2
+        files.append(file)
+    # Add fastq files from directory. Entries from os.scandir know whether they
+    # are files without an additional stat call.
+    if args.from_dir:
+        try:
+            with os.scandir(args.from_dir) as entries:
+                files.extend(
+                    sorted(
+                        pathlib.Path(entry.path)
+                        for entry in entries
+                        if entry.name.endswith(".fastq") and entry.is_file()
+                    )
+                )
+        except OSError as e:
+            print(f"{SCRIPT_NAME}: error: {e}")
+            return 2
 
     # Instantiate ManifestFile accordingly to passed command-line arguments.
     if args.append:
@@ -240,18 +385,18 @@ def main() -> int:
         if not file.exists():
             print(f"{SCRIPT_NAME}: error: File {file} not found!")
             return 1
-        manifest = ManifestFile.from_file(pathlib.Path(args.append))
+        manifest = ManifestFile.from_file(file)
     elif args.output:
         file = pathlib.Path(args.output)
         if args.no_overwrite:
             if file.exists():
                 print(f"{SCRIPT_NAME}: error: File {file} exists!")
                 return 1
-        manifest = ManifestFile(pathlib.Path(args.output))
+        manifest = ManifestFile(file)
     else:
         manifest = ManifestFile(pathlib.Path("stdout"))
 
-    # Add entries to ManifestFile
+    replace_function = None
     if args.regex_pattern:
         try:
             _, pattern, repl, options = re.split(r'(?<![^\\]\\)/', args.regex_pattern)
@@ -260,23 +405,39 @@ def main() -> int:
                 f"{SCRIPT_NAME}: error: substitution string must be sed-like, that is of a form: `s/pattern/replacement/[g]`."
             )
             return 1
-        else:
-            replace_function = functools.partial(
-                re.sub, pattern=pattern, repl=re.sub(r'\\/', '/', repl), count = "g" not in options
-            )
-            manifest.extend_manifest(files, args.infer, replace_function)
-    else:
-        manifest.extend_manifest(files, args.infer)
+        repl = re.sub(r'\\/', '/', repl)
+        try:
+            regex = re.compile(pattern)
+            # Replacement is parsed on first substitution, so doing one here
+            # checks it before anything is written.
+            regex.sub(repl, "")
+        except (re.error, IndexError) as e:
+            print(f"{SCRIPT_NAME}: error: invalid substitution string: {e}")
+            return 1
+        replace_function = functools.partial(regex.sub, repl, count="g" not in options)
 
-    # Create manifest file or append to existing manifest file. Else print
-    # results to stdout. Return 0, meaning a success.
-    if args.append:
-        manifest.emit("a")
-    elif args.output:
-        manifest.emit("w")
+    # Infer directions before opening the manifest file, so that it's left
+    # intact if inference fails.
+    directions = None
+    if args.infer:
+        try:
+            directions = infer_directions(files)
+        except InferenceError as e:
+            print(e)
+            return 1
+
+    # Add entries to ManifestFile, writing them straight to the manifest file
+    # when creating or appending to one. Else print results to stdout, only
+    # after all entries were generated. Return 0, meaning a success.
+    if args.append or args.output:
+        with manifest.open_stream("a" if args.append else "w") as handle:
+            manifest.extend_manifest(
+                files, args.infer, replace_function, handle, directions=directions
+            )
     else:
-        for line in manifest.unwritten_lines:
-            print(line, end="")
+        manifest.extend_manifest(files, args.infer, replace_function, directions=directions)
+        manifest.write_to(sys.stdout.buffer)
+        sys.stdout.buffer.flush()
     return 0
 
 